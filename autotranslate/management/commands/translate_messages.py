@@ -1,23 +1,28 @@
+import functools
 import logging
+import mmap
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from html.parser import HTMLParser
-from optparse import make_option
 
 import polib
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from autotranslate.utils import get_translator
 
 logger = logging.getLogger(__name__)
 
-# not sure whether we actually need this
-# just making this change for backward compatibility
-# it was always empty anyways
-# https://github.com/django/django/blob/1.9/django/core/management/base.py#L210
-default_options = () if not hasattr(BaseCommand, 'option_list') \
-    else BaseCommand.option_list
+_SPECIAL_CHARS_RE = re.compile(r'[<&%\n]')
+_PLACEHOLDER_RE = re.compile(r'(%(\(\w+\))?([sd]))|(\n)')
+_RESTORE_RE = re.compile(r'<span translate="no">(%(\(\w+\))?([sd]))</span>|<br translate="no">')
+
+# an empty msgstr, possibly continued by empty strings only;
+# the optional group catches the header, viz. an empty msgid directly followed by msgstr
+_UNTRANSLATED_RE = re.compile(rb'^[ \t]*(msgid[ \t]*""[ \t]*\r?\n[ \t]*)?msgstr(?:\[\d+\])?[ \t]*""[ \t]*'
+                              rb'(?:\r?\n[ \t]*""[ \t]*)*(?:\r?\n(?![ \t]*")|\Z)', re.MULTILINE)
 
 
 class HTMLTranslator(HTMLParser):
@@ -26,57 +31,58 @@ class HTMLTranslator(HTMLParser):
     def __init__(self, convert_charrefs=False):
         """We do not want to convert charrefs."""
         super().__init__(convert_charrefs=convert_charrefs)
+        self._parts = []
 
     def convert(self, data):
-        self.converted = ''
+        self.reset()
+        self._parts.clear()
         self.feed(data)
         self.close()
-        return self.converted
+        return ''.join(self._parts)
 
     def handle_starttag(self, tag, attrs):
-        self.converted += f"<{tag}"
-        for attr_name, attr_value in attrs:
-            self.converted += f' {attr_name}="{attr_value}"'
-        self.converted += ">"
+        # str.join() materializes a generator into a list anyway, so pass it one directly
+        attr_str = ''.join([f' {attr_name}="{attr_value}"' for attr_name, attr_value in attrs])
+        self._parts.append(f"<{tag}{attr_str}>")
 
     def handle_endtag(self, tag):
-        self.converted += f"</{tag}>"
+        self._parts.append(f"</{tag}>")
 
     def handle_charref(self, name):
-        self.converted += f"&#{name};"
+        self._parts.append(f"&#{name};")
 
     def handle_entityref(self, name):
-        self.converted += f"&{name};"
+        self._parts.append(f"&{name};")
 
     def handle_data(self, data):
-        self.converted += _convert_text(data)
+        self._parts.append(_convert_text(data))
 
     def handle_comment(self, data):
-        self.converted += f"<!--{data}-->"
+        self._parts.append(f"<!--{data}-->")
 
     def handle_decl(self, data):
-        self.converted += f"<!{data}>"
+        self._parts.append(f"<!{data}>")
 
     def handle_pi(self, data):
-        self.converted += f"<?{data}>"
+        self._parts.append(f"<?{data}>")
+
+
+# HTMLTranslator keeps parser state between feed() calls,
+# so each thread gets its own reusable instance
+_local = threading.local()
+
+
+def _get_html_translator():
+    translator = getattr(_local, 'translator', None)
+    if translator is None:
+        translator = _local.translator = HTMLTranslator()
+    return translator
 
 
 class Command(BaseCommand):
     help = ('autotranslate all the message files that have been generated '
             'using the `makemessages` command.')
 
-    option_list = default_options + (
-        make_option('--locale', '-l', default=[], dest='locale', action='append',
-                    help='autotranslate the message files for the given locale(s) (e.g. pt_BR). '
-                         'can be used multiple times.'),
-        make_option('--untranslated', '-u', default=False, dest='skip_translated', action='store_true',
-                    help='autotranslate the fuzzy and empty messages only.'),
-        make_option('--set-fuzzy', '-f', default=False, dest='set_fuzzy', action='store_true',
-                    help='set the fuzzy flag on autotranslated messages.'),
-        make_option('--source-language', '-s', default='en', dest='source_language', action='store',
-                    help='override the default source language (en) used for translation.'),
-    )
-
     def add_arguments(self, parser):
         # Previously, only the standard optparse library was supported and
         # you would have to extend the command option_list variable with optparse.make_option().
@@ -91,36 +97,78 @@ class Command(BaseCommand):
                             help='set the fuzzy flag on autotranslated messages.')
         parser.add_argument('--source-language', '-s', default='en', dest='source_language', action='store',
                             help='override the default source language (en) used for translation.')
+        parser.add_argument('--jobs', '-j', default=8, dest='jobs', type=int, action='store',
+                            help='number of locales to translate concurrently (default 8).')
 
     def set_options(self, **options):
         self.locale = options['locale']
         self.skip_translated = options['skip_translated']
         self.set_fuzzy = options['set_fuzzy']
         self.source_language = options['source_language']
+        self.jobs = options['jobs']
 
     def handle(self, *args, **options):
         self.set_options(**options)
 
         assert getattr(settings, 'USE_I18N', False), 'i18n framework is disabled'
         assert getattr(settings, 'LOCALE_PATHS', []), 'locale paths is not configured properly'
+        if self.jobs < 1:
+            raise CommandError('--jobs should be at least 1, got {}'.format(self.jobs))
+
+        files_by_language = {}
         for directory in settings.LOCALE_PATHS:
-            # walk through all the paths
-            # and find all the pot files
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if not file.endswith('.po'):
-                        # process file only
-                        # if its a pot file
-                        continue
+            for target_language, file_path in self.find_files(directory):
+                files_by_language.setdefault(target_language, []).append(file_path)
+
+        # translating is dominated by the round-trip to the translator service,
+        # so all the files of a locale are translated in a single request
+        # and the locales are translated concurrently, while the translations
+        # already received are written to disk on the main thread
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self.fetch_translations, target_language, file_paths)
+                       for target_language, file_paths in files_by_language.items()]
+            try:
+                for future in as_completed(futures):
+                    self.save_translations(*future.result())
+            except BaseException:
+                # do not wait for the locales still queued, their translations would not be saved anyway
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def find_files(self, directory):
+        """
+        find all the pot files laid out as `<directory>/<locale>/LC_MESSAGES/*.po`
+
+        :param directory: the absolute path of a locale folder (one of LOCALE_PATHS)
+        :return:          generator of (target_language, file_path)
+        """
+        try:
+            with os.scandir(directory) as entries:
+                language_dirs = list(entries)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return
+
+        for language_dir in language_dirs:
+            if not language_dir.is_dir():
+                continue
+
+            # get the target language from the folder name
+            target_language = language_dir.name
 
-                    # get the target language from the parent folder name
-                    target_language = os.path.basename(os.path.dirname(root))
+            if self.locale and target_language not in self.locale:
+                logger.info('skipping translation for locale `{}`'.format(target_language))
+                continue
 
-                    if self.locale and target_language not in self.locale:
-                        logger.info('skipping translation for locale `{}`'.format(target_language))
-                        continue
+            try:
+                with os.scandir(os.path.join(language_dir.path, 'LC_MESSAGES')) as files:
+                    file_paths = [file.path for file in files
+                                  if file.name.endswith('.po') and file.is_file(follow_symlinks=False)]
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
 
-                    self.translate_file(root, file, target_language)
+            for file_path in file_paths:
+                yield target_language, file_path
 
     def translate_file(self, root, file_name, target_language):
         """
@@ -130,22 +178,98 @@ class Command(BaseCommand):
         :param file_name:       name of the file to be translated (it should be a pot file)
         :param target_language: language in which the file needs to be translated
         """
+        self.translate_files(target_language, [os.path.join(root, file_name)])
+
+    def translate_files(self, target_language, file_paths):
+        """
+        translate several pot files of the same locale using a single request to the translator service
+
+        :param target_language: language in which the files need to be translated
+        :param file_paths:      absolute paths of the files to be translated (they should be pot files)
+        """
+        self.save_translations(*self.fetch_translations(target_language, file_paths))
+
+    def fetch_translations(self, target_language, file_paths):
+        """
+        read the pot files of a locale and translate their strings using a single request
+
+        :param target_language: language in which the files need to be translated
+        :param file_paths:      absolute paths of the files to be translated (they should be pot files)
+        :return:                tuple of (batches, translated_strings) to be passed to save_translations()
+        """
         logger.info('filling up translations for locale `{}`'.format(target_language))
 
-        po = polib.pofile(os.path.join(root, file_name))
-        strings = self.get_strings_to_translate(po)
+        # (po, entries, start, end) where translated_strings[start:end]
+        # are the translations of the entries of the po file
+        batches = []
+        strings = []
+        for file_path in file_paths:
+            if self.skip_translated and not has_untranslated_entries(file_path):
+                # no need to parse the file
+                logger.info('skipping translated file `{}`'.format(file_path))
+                continue
+
+            po = polib.pofile(file_path)
+            entries, po_strings = self._collect(po)
+            batches.append((po, entries, len(strings), len(strings) + len(po_strings)))
+            strings.extend(po_strings)
+
+        if not strings:
+            # nothing to translate, do not even set up the translator service
+            return batches, []
 
         # translate the strings,
         # all the translated strings are returned
         # in the same order on the same index
         # viz. [a, b] -> [trans_a, trans_b]
+        # the same msgid is often found in several entries or files,
+        # so each distinct string is sent only once and expanded back afterwards
+        unique_strings = list(dict.fromkeys(strings))
         tl = get_translator()
-        translated_strings = tl.translate_strings(strings, target_language, self.source_language, False)
-        self.update_translations(po, translated_strings)
-        po.save()
+        unique_translations = tl.translate_strings(unique_strings, target_language, self.source_language, False)
+        if len(unique_translations) != len(unique_strings):
+            raise CommandError('expected {} translations, got {}'.format(len(unique_strings), len(unique_translations)))
+        translations = dict(zip(unique_strings, unique_translations))
+        translated_strings = [translations[string] for string in strings]
+        return batches, translated_strings
+
+    def save_translations(self, batches, translated_strings):
+        """
+        fill up the translations returned by fetch_translations() and save the pot files
+
+        :param batches:            list of (po, entries, start, end) as returned by fetch_translations()
+        :param translated_strings: list of translations for all the batches
+        """
+        for po, entries, start, end in batches:
+            self.update_translations(entries, translated_strings[start:end])
+            po.save()
 
     def need_translate(self, entry):
-        return not entry.obsolete and (not (self.skip_translated and (entry.translated() or entry.fuzzy)))
+        # check the plain attributes first, entry.translated() walks the msgstr(s)
+        return not entry.obsolete and (not (self.skip_translated and (entry.fuzzy or entry.translated())))
+
+    def _collect(self, po):
+        """Return the entries to translate along with their strings, in a single pass over po file.
+
+        :param po: POFile object to translate
+        :type po: polib.POFile
+        :return: tuple of (entries to translate, strings to translate)
+        :rtype: (list[polib.POEntry], list[six.text_type])
+        """
+        entries = []
+        strings = []
+        # bind the per-entry lookups once
+        need_translate = self.need_translate
+        add_entry = entries.append
+        add_string = strings.append
+        for entry in po:
+            if not need_translate(entry):
+                continue
+            add_entry(entry)
+            add_string(convert_text(entry.msgid))
+            if entry.msgid_plural:
+                add_string(convert_text(entry.msgid_plural))
+        return entries, strings
 
     def get_strings_to_translate(self, po):
         """Return list of string to translate from po file.
@@ -155,30 +279,21 @@ class Command(BaseCommand):
         :return: list of string to translate
         :rtype: collections.Iterable[six.text_type]
         """
-        strings = []
-        for index, entry in enumerate(po):
-            if not self.need_translate(entry):
-                continue
-            strings.append(convert_text(entry.msgid))
-            if entry.msgid_plural:
-                strings.append(convert_text(entry.msgid_plural))
-        return strings
+        return self._collect(po)[1]
 
     def update_translations(self, entries, translated_strings):
         """Update translations in entries.
 
-        The order and number of translations should match to get_strings_to_translate() result.
+        The entries should be the ones that need translation (as collected by _collect())
+        and the order and number of translations should match to get_strings_to_translate() result.
 
         :param entries: list of entries to translate
-        :type entries: collections.Iterable[polib.POEntry] | polib.POFile
+        :type entries: collections.Iterable[polib.POEntry]
         :param translated_strings: list of translations
         :type translated_strings: collections.Iterable[six.text_type]
         """
         translations = iter(translated_strings)
         for entry in entries:
-            if not self.need_translate(entry):
-                continue
-
             if entry.msgid_plural:
                 # fill the first plural form with the entry.msgid translation
                 translation = next(translations)
@@ -188,9 +303,8 @@ class Command(BaseCommand):
                 # fill the rest of plural forms with the entry.msgid_plural translation
                 translation = next(translations)
                 translation = fix_translation(entry.msgid_plural, translation)
-                for k, v in entry.msgstr_plural.items():
-                    if k != 0:
-                        entry.msgstr_plural[k] = translation
+                for k in range(1, len(entry.msgstr_plural)):
+                    entry.msgstr_plural[k] = translation
             else:
                 translation = next(translations)
                 translation = fix_translation(entry.msgid, translation)
@@ -201,12 +315,18 @@ class Command(BaseCommand):
                 entry.flags.append('fuzzy')
 
 
+@functools.lru_cache(maxsize=16384)
 def convert_text(msgid):
     """
     Convert html text to (google translate) service friendly form.
     """
-    translator = HTMLTranslator()
-    return translator.convert(msgid)
+    if not _SPECIAL_CHARS_RE.search(msgid):
+        # no html, placeholders or newlines, nothing to convert
+        return msgid
+    if '<' not in msgid and '&' not in msgid:
+        # no html, only the placeholders and newlines need to be converted
+        return _convert_text(msgid)
+    return _get_html_translator().convert(msgid)
 
 
 def _convert_text(msgid):
@@ -222,21 +342,32 @@ def _convert_text(msgid):
 
         <a href="{{ var }}">text</a>
     """
-    return re.sub(
-        r'(%(\(\w+\))?([sd]))',
-        r'<span translate="no">\1</span>',
-        msgid).replace('\n', '<br translate="no">')
+    return _PLACEHOLDER_RE.sub(
+        lambda m: '<br translate="no">' if m.group(4) else f'<span translate="no">{m.group(1)}</span>',
+        msgid)
 
 
 def restore_text(translation):
     """Restore text to original form."""
-    return re.sub(
-        r'<span translate="no">(%(\(\w+\))?([sd]))</span>',
-        r'\1',
-        translation).replace('<br translate="no">', '\n')
+    return _RESTORE_RE.sub(lambda m: m.group(1) or '\n', translation)
+
+
+def has_untranslated_entries(file_path):
+    """
+    Cheaply check whether a pot file has any empty messages, without parsing it.
+
+    Errs on the side of True, the entries are properly checked after parsing the file.
+    """
+    if not os.path.getsize(file_path):
+        return False
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return any(not match.group(1) for match in _UNTRANSLATED_RE.finditer(m))
 
 
 def fix_translation(msgid, translation):
+    # Remove spaces that have been placed between %(id) tags
+    translation = restore_text(translation)
+
     # Google Translate removes a lot of formatting, these are the fixes:
     # - Add newline in the beginning if msgid also has that
     if msgid.startswith('\n') and not translation.startswith('\n'):
@@ -246,6 +377,4 @@ def fix_translation(msgid, translation):
     if msgid.endswith('\n') and not translation.endswith('\n'):
         translation += u'\n'
 
-    # Remove spaces that have been placed between %(id) tags
-    translation = restore_text(translation)
     return translation
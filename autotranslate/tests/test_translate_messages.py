@@ -1,4 +1,7 @@
 import os
+import shutil
+import tempfile
+import time
 
 try:
     # python2.6
@@ -7,11 +10,25 @@ except ImportError:
     import unittest
 
 import polib
+from django.core.management import CommandError, call_command
+from django.test import override_settings
 
-from autotranslate.management.commands.translate_messages import convert_text, restore_text, Command
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from autotranslate.management.commands.translate_messages import (
+    convert_text, restore_text, fix_translation, has_untranslated_entries, Command
+)
 
 
 class ConvertTestCase(unittest.TestCase):
+    def test_plain_text(self):
+        self.assertEqual('foo bar', convert_text('foo bar'))
+        self.assertEqual('foo > bar', convert_text('foo > bar'))
+        self.assertEqual('', convert_text(''))
+
     def test_named_placeholders(self):
         self.assertEqual('foo <span translate="no">%(item)s</span> bar', convert_text('foo %(item)s bar'))
         self.assertEqual('foo <span translate="no">%(item_name)s</span> bar', convert_text('foo %(item_name)s bar'))
@@ -71,6 +88,17 @@ class RestoreTestCase(unittest.TestCase):
         self.assertEqual('baz %s%s zilot',
                          restore_text('baz <span translate="no">%s</span><span translate="no">%s</span> zilot'))
 
+    def test_restore_newline(self):
+        self.assertEqual('baz\n%s\nzilot',
+                         restore_text('baz<br translate="no"><span translate="no">%s</span><br translate="no">zilot'))
+
+    def test_fix_newlines(self):
+        # kept by the translator
+        self.assertEqual('\nfoo\n', fix_translation('\nfoo\n', convert_text('\nfoo\n')))
+        # dropped by the translator
+        self.assertEqual('\nfoo\n', fix_translation('\nfoo\n', 'foo'))
+        self.assertEqual('foo', fix_translation('foo', 'foo'))
+
     def test_html_placeholders(self):
         self.assertEqual('foo <a href="%(url)s">%(link)s</a> bar',
                          restore_text('foo <a href="%(url)s"><span translate="no">%(link)s</span></a> bar'))
@@ -86,6 +114,7 @@ class POFileTestCase(unittest.TestCase):
                 set_fuzzy=False,
                 skip_translated=False,
                 source_language='en',
+                jobs=1,
         ))
         self.cmd = cmd
         self.po = polib.pofile(os.path.join(os.path.dirname(__file__), 'data/django.po'))
@@ -115,3 +144,206 @@ class POFileTestCase(unittest.TestCase):
         self.assertEqual(['PLURAL'] * (len(entry.msgstr_plural) - 1),
                          [v for k, v in entry.msgstr_plural.items() if k != 0])
         self.assertTrue(entry.translated())
+
+    def test_should_skip_translated(self):
+        self.cmd.skip_translated = True
+        self.po[0].msgstr = 'XXXX'
+        entries, strings = self.cmd._collect(self.po)
+        self.assertEqual([self.po[1]], entries)
+        self.assertEqual(['City', 'Cities'], strings)
+
+
+class FindFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        cmd = Command()
+        cmd.set_options(**dict(
+                locale=[],
+                set_fuzzy=False,
+                skip_translated=False,
+                source_language='en',
+                jobs=1,
+        ))
+        self.cmd = cmd
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for path in ('de/LC_MESSAGES/django.po', 'de/LC_MESSAGES/django.mo', 'es/LC_MESSAGES/djangojs.po',
+                     'fr/django.po', 'README'):
+            path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def find_files(self, directory=None):
+        return sorted(self.cmd.find_files(directory or self.directory))
+
+    def test_should_find_po_files(self):
+        self.assertEqual([('de', os.path.join(self.directory, 'de', 'LC_MESSAGES', 'django.po')),
+                          ('es', os.path.join(self.directory, 'es', 'LC_MESSAGES', 'djangojs.po'))],
+                         self.find_files())
+
+    def test_should_filter_locale(self):
+        self.cmd.locale = ['es']
+        self.assertEqual([('es', os.path.join(self.directory, 'es', 'LC_MESSAGES', 'djangojs.po'))],
+                         self.find_files())
+
+    def test_should_ignore_missing_directory(self):
+        self.assertEqual([], self.find_files(os.path.join(self.directory, 'missing')))
+
+
+class EchoTranslator:
+    def __init__(self):
+        self.requests = []
+
+    def translate_strings(self, strings, target_language, source_language='en', optimized=True):
+        self.requests.append(list(strings))
+        return ['{}:{}'.format(target_language, s) for s in strings]
+
+
+class ShortTranslator(EchoTranslator):
+    def translate_strings(self, strings, target_language, source_language='en', optimized=True):
+        return super().translate_strings(strings, target_language, source_language, optimized)[:-1]
+
+
+class TranslateFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        cmd = Command()
+        cmd.set_options(**dict(
+                locale=[],
+                set_fuzzy=False,
+                skip_translated=True,
+                source_language='en',
+                jobs=1,
+        ))
+        self.cmd = cmd
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.file_paths = []
+        for name in ('a.po', 'b.po'):
+            file_path = os.path.join(tmp_dir, name)
+            shutil.copy(os.path.join(os.path.dirname(__file__), 'data/django.po'), file_path)
+            self.file_paths.append(file_path)
+
+        # the first entry of the second file is already translated
+        po = polib.pofile(self.file_paths[1])
+        po[0].msgstr = 'XXXX'
+        po.save()
+
+    def translate(self, translator):
+        with mock.patch('autotranslate.management.commands.translate_messages.get_translator',
+                        return_value=translator):
+            self.cmd.save_translations(*self.cmd.fetch_translations('de', self.file_paths))
+        return [polib.pofile(file_path) for file_path in self.file_paths]
+
+    def test_should_update_files(self):
+        po_a, po_b = self.translate(EchoTranslator())
+        self.assertEqual('de:Location', po_a[0].msgstr)
+        self.assertEqual('XXXX', po_b[0].msgstr)
+        for po in (po_a, po_b):
+            self.assertEqual('de:City', po[1].msgstr_plural[0])
+            self.assertEqual(['de:Cities'] * (len(po[1].msgstr_plural) - 1),
+                             [v for k, v in po[1].msgstr_plural.items() if k != 0])
+
+    def test_should_send_duplicates_once(self):
+        translator = EchoTranslator()
+        self.translate(translator)
+        self.assertEqual([['Location', 'City', 'Cities']], translator.requests)
+
+    def test_should_fail_on_missing_translations(self):
+        with self.assertRaisesRegex(CommandError, 'expected 3 translations, got 2'):
+            self.translate(ShortTranslator())
+        # nothing is saved
+        self.assertEqual('', polib.pofile(self.file_paths[0])[0].msgstr)
+
+
+class FailingTranslator(EchoTranslator):
+    """Fails the first request, the next ones are slowed down so the failure is handled first."""
+
+    def translate_strings(self, strings, target_language, source_language='en', optimized=True):
+        self.requests.append(list(strings))
+        if len(self.requests) == 1:
+            raise RuntimeError('translator failure')
+        time.sleep(0.5)
+        return ['{}:{}'.format(target_language, s) for s in strings]
+
+
+class HandleTestCase(unittest.TestCase):
+    LANGUAGES = ('de', 'es', 'fr', 'it')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for language in self.LANGUAGES:
+            file_path = self.file_path(language)
+            os.makedirs(os.path.dirname(file_path))
+            shutil.copy(os.path.join(os.path.dirname(__file__), 'data/django.po'), file_path)
+
+    def file_path(self, language):
+        return os.path.join(self.directory, language, 'LC_MESSAGES', 'django.po')
+
+    def translate(self, translator, *args):
+        with override_settings(LOCALE_PATHS=[self.directory]), \
+                mock.patch('autotranslate.management.commands.translate_messages.get_translator',
+                           return_value=translator):
+            call_command('translate_messages', *args)
+
+    def translations(self):
+        return {language: polib.pofile(self.file_path(language))[0].msgstr for language in self.LANGUAGES}
+
+    def test_should_save_all_locales(self):
+        self.translate(EchoTranslator())
+        self.assertEqual({language: '{}:Location'.format(language) for language in self.LANGUAGES},
+                         self.translations())
+
+    def test_should_save_all_locales_with_jobs(self):
+        self.translate(EchoTranslator(), '-j', '2')
+        self.assertEqual({language: '{}:Location'.format(language) for language in self.LANGUAGES},
+                         self.translations())
+
+    def test_should_reject_no_jobs(self):
+        translator = EchoTranslator()
+        with self.assertRaisesRegex(CommandError, '--jobs should be at least 1'):
+            self.translate(translator, '-j', '0')
+        self.assertEqual([], translator.requests)
+
+    def test_should_filter_locale(self):
+        self.translate(EchoTranslator(), '-l', 'de', '-l', 'fr')
+        self.assertEqual({'de': 'de:Location', 'es': '', 'fr': 'fr:Location', 'it': ''}, self.translations())
+
+    def test_should_stop_on_failure(self):
+        translator = FailingTranslator()
+        with self.assertRaisesRegex(RuntimeError, 'translator failure'):
+            self.translate(translator, '-j', '1')
+        # the locales still queued are cancelled and nothing is saved
+        self.assertLess(len(translator.requests), len(self.LANGUAGES))
+        self.assertEqual({language: '' for language in self.LANGUAGES}, self.translations())
+
+
+class UntranslatedScanTestCase(unittest.TestCase):
+    HEADER = ('#, fuzzy\n'
+              'msgid ""\n'
+              'msgstr ""\n'
+              '"Content-Type: text/plain; charset=UTF-8\\n"\n'
+              '\n')
+
+    def scan(self, content):
+        with tempfile.NamedTemporaryFile('w', suffix='.po', delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        return has_untranslated_entries(f.name)
+
+    def test_untranslated(self):
+        self.assertTrue(has_untranslated_entries(os.path.join(os.path.dirname(__file__), 'data/django.po')))
+        self.assertTrue(self.scan(self.HEADER + 'msgid "Location"\nmsgstr ""'))
+        # continued by empty strings only
+        self.assertTrue(self.scan(self.HEADER + 'msgid "a"\nmsgstr ""\n""\n'))
+        # indented
+        self.assertTrue(self.scan(self.HEADER + 'msgid "a"\n  msgstr ""\n'))
+        # an empty msgid is only the header when msgstr follows it directly
+        self.assertTrue(self.scan(self.HEADER + 'msgid ""\n"Location"\nmsgstr ""\n'))
+
+    def test_translated(self):
+        self.assertFalse(self.scan(self.HEADER +
+                                   '#, python-format\nmsgid "%s"\nmsgstr "XXXX"\n\n'
+                                   'msgid "Location"\nmsgstr ""\n"XXXX"\n\n'
+                                   'msgid "City"\nmsgid_plural "Cities"\nmsgstr[0] "X"\nmsgstr[1] "XX"\n'))